@@ -1,8 +1,13 @@
+import asyncio
+import io
 import os
+import sys
 import logging
 from pathlib import Path
+import shutil
 import tempfile
-from typing import Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, BinaryIO, Optional, Union
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -16,6 +21,7 @@ from telegram.ext import (
     ContextTypes,
     CallbackQueryHandler
 )
+from telegram.error import TelegramError
 
 # File conversion imports
 from PIL import Image
@@ -37,35 +43,99 @@ class FileConverter:
         }
     }
     
+    # Flat extension -> category lookup, built once from SUPPORTED_CONVERSIONS
+    _EXT_TO_CATEGORY = {
+        ext: category
+        for category, formats in SUPPORTED_CONVERSIONS.items()
+        for ext in formats['from']
+    }
+    
     @staticmethod
     def get_file_category(extension: str) -> str:
         """Determine the category of a file based on its extension"""
-        for category, formats in FileConverter.SUPPORTED_CONVERSIONS.items():
-            if extension.lower() in formats['from']:
-                return category
-        return 'unknown'
+        return FileConverter._EXT_TO_CATEGORY.get(extension.lower(), 'unknown')
+    
+    # Conversion keyboards per (category, source extension), built once.
+    # Pairs whose only target is the source format itself are left out.
+    _MARKUPS = {
+        (category, ext): InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"Convert to {fmt.upper()}",
+                                  callback_data=f"convert_{fmt[1:]}")]  # Remove the dot
+            for fmt in formats['to'] if fmt != ext
+        ])
+        for category, formats in SUPPORTED_CONVERSIONS.items()
+        for ext in formats['from']
+        if any(fmt != ext for fmt in formats['to'])
+    }
+    
+    @staticmethod
+    def get_conversion_markup(category: str, extension: str) -> Optional[InlineKeyboardMarkup]:
+        """Return the conversion keyboard for a file, or None if it has no targets"""
+        return FileConverter._MARKUPS.get((category, extension.lower()))
     
     @staticmethod
-    def convert_image(input_path: str, output_path: str, target_format: str) -> bool:
-        """Convert image files"""
+    def _copy_file(source: Union[str, BinaryIO], output: Union[str, BinaryIO]) -> None:
+        """Copy raw bytes between paths and/or binary file objects"""
+        if isinstance(source, str):
+            with open(source, 'rb') as source_file:
+                FileConverter._copy_file(source_file, output)
+        elif isinstance(output, str):
+            with open(output, 'wb') as output_file:
+                FileConverter._copy_file(source, output_file)
+        else:
+            source.seek(0)
+            shutil.copyfileobj(source, output)
+    
+    @staticmethod
+    def convert_image(source: Union[str, BinaryIO], output: Union[str, BinaryIO],
+                      target_format: str) -> bool:
+        """Convert image files between paths or binary file objects"""
+        # Pillow only knows the JPEG encoder by its format name
+        pil_format = 'JPEG' if target_format.upper() in ['JPEG', 'JPG'] else target_format.upper()
+        save_kwargs: Dict[str, Any] = {}
         try:
-            with Image.open(input_path) as img:
-                # Handle transparency for formats that don't support it
-                if target_format.upper() in ['JPEG', 'JPG'] and img.mode in ('RGBA', 'LA', 'P'):
-                    background = Image.new('RGB', img.size, (255, 255, 255))
-                    background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                    img = background
+            with Image.open(source) as img:
+                # Same codec on both sides (e.g. .jpeg -> .jpg): copy the bytes as-is
+                if img.format == pil_format:
+                    FileConverter._copy_file(source, output)
+                    return True
+                
+                if pil_format == 'JPEG':
+                    # Handle transparency for formats that don't support it
+                    if img.mode in ('RGBA', 'LA', 'P'):
+                        if img.mode != 'RGBA':
+                            img = img.convert('RGBA')
+                        background = Image.new('RGB', img.size, (255, 255, 255))
+                        background.paste(img, mask=img.getchannel('A'))
+                        img = background
+                elif pil_format == 'PNG':
+                    # Fast zlib level: much quicker encode for a modestly larger file
+                    save_kwargs.update(compress_level=1)
                 
-                img.save(output_path, target_format.upper())
+                img.save(output, pil_format, **save_kwargs)
             return True
         except Exception as e:
             logger.error(f"Image conversion error: {e}")
             return False
 
+class _SpooledOutput(tempfile.SpooledTemporaryFile):
+    """SpooledTemporaryFile that Pillow can encode into without forcing a rollover"""
+    
+    def fileno(self) -> int:
+        # Pillow's encoders ask for fileno() first; a real one would roll over to disk
+        raise io.UnsupportedOperation("fileno")
+
 class TelegramBot:
+    MAX_CONCURRENT_CONVERSIONS = os.cpu_count() or 1
+    MAX_CONCURRENT_UPLOADS = 4  # Each upload holds up to MAX_FILE_SIZE in memory
+    
     def __init__(self, token: str):
-        self.application = Application.builder().token(token).build()
+        # Handle updates concurrently so one slow conversion doesn't stall other users
+        self.application = Application.builder().token(token).concurrent_updates(True).build()
         self.converter = FileConverter()
+        self._pool = ThreadPoolExecutor(max_workers=self.MAX_CONCURRENT_CONVERSIONS)
+        self._conversion_slots = asyncio.Semaphore(self.MAX_CONCURRENT_CONVERSIONS)
+        self._upload_slots = asyncio.Semaphore(self.MAX_CONCURRENT_UPLOADS)
         self.setup_handlers()
     
     def setup_handlers(self):
@@ -123,10 +193,13 @@ class TelegramBot:
     async def handle_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle photo uploads"""
         photo = update.message.photo[-1]  # Get highest resolution
-        file_name = f"image_{photo.file_id}.jpg"
+        # file_unique_id is stable across forwards, so converted results can be reused
+        file_name = f"image_{photo.file_unique_id}.jpg"
         await self.process_file(update, context, photo, file_name)
     
     MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
+    IN_MEMORY_LIMIT = 8 * 1024 * 1024  # Files up to 8MB never touch disk
+    CONVERSION_CACHE_SIZE = 1024  # Converted file_ids remembered for reuse
 
     async def process_file(self, update: Update, context: ContextTypes.DEFAULT_TYPE, 
                           file_obj: Document, file_name: str):
@@ -153,27 +226,15 @@ class TelegramBot:
             'category': file_category
         }
         
-        # Show conversion options
-        available_formats = self.converter.SUPPORTED_CONVERSIONS[file_category]['to']
-        current_format = file_extension.lower()
+        # Show conversion options (current format is already excluded)
+        reply_markup = self.converter.get_conversion_markup(file_category, file_extension)
         
-        # Remove current format from options
-        conversion_options = [fmt for fmt in available_formats if fmt != current_format]
-        
-        if not conversion_options:
+        if reply_markup is None:
             await update.message.reply_text(
                 "❌ No conversion options available for this file."
             )
             return
         
-        # Create inline keyboard with format options
-        keyboard = []
-        for fmt in conversion_options:
-            callback_data = f"convert_{fmt[1:]}"  # Remove the dot
-            keyboard.append([InlineKeyboardButton(f"Convert to {fmt.upper()}", 
-                                                callback_data=callback_data)])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
             f"📁 File received: {file_name}\n"
             f"🔸 Type: {file_category.title()}\n"
@@ -197,55 +258,94 @@ class TelegramBot:
         await query.edit_message_text("🔄 Converting file, please wait...")
         
         try:
-            # Download the file
             file_obj = file_info['file_obj']
-            temp_dir = tempfile.mkdtemp()
-            input_path = os.path.join(temp_dir, file_info['file_name'])
-            
-            file = await context.bot.get_file(file_obj.file_id)
-            await file.download_to_drive(input_path)
-            
-            # Prepare output file
             input_name = Path(file_info['file_name']).stem
             output_filename = f"{input_name}.{target_format}"
-            output_path = os.path.join(temp_dir, output_filename)
-            
-            # Perform conversion
-            success = self.convert_file(input_path, output_path, 
-                                      file_info['category'], target_format)
             
-            if success and os.path.exists(output_path):
-                # Send converted file
-                with open(output_path, 'rb') as converted_file:
+            # Same content was converted before: Telegram can resend it by file_id.
+            # A resent file keeps the name it was uploaded with, so the name is part of the key.
+            cache_key = f"{file_obj.file_unique_id}:{output_filename}"
+            conversion_cache = context.bot_data.setdefault('conversion_cache', {})
+            cached_file_id = conversion_cache.get(cache_key)
+            if cached_file_id:
+                try:
                     await context.bot.send_document(
                         chat_id=query.message.chat_id,
-                        document=converted_file,
-                        filename=output_filename,
+                        document=cached_file_id,
                         caption=f"✅ Converted to {target_format.upper()}"
                     )
-                await query.edit_message_text("✅ Conversion completed successfully!")
-            else:
-                await query.edit_message_text("❌ Conversion failed. Please try again.")
+                except TelegramError as e:
+                    # Stale or rejected file_id: forget it and convert from scratch
+                    logger.warning(f"Cached result {cache_key} rejected: {e}")
+                    conversion_cache.pop(cache_key, None)
+                else:
+                    await query.edit_message_text("✅ Conversion completed successfully!")
+                    return
             
-            # Cleanup
-            import shutil
-            shutil.rmtree(temp_dir, ignore_errors=True)
+            # Output stays in memory up to IN_MEMORY_LIMIT and spills to disk beyond that
+            with _SpooledOutput(max_size=self.IN_MEMORY_LIMIT) as output_file:
+                # Bound in-flight downloads and conversions to the available CPUs
+                async with self._conversion_slots:
+                    file = await context.bot.get_file(file_obj.file_id)
+                    with tempfile.SpooledTemporaryFile(max_size=self.IN_MEMORY_LIMIT) as input_file:
+                        await file.download_to_memory(input_file)
+                        input_file.seek(0)
+                        
+                        # Perform conversion
+                        success = await self.convert_file(input_file, output_file, 
+                                                          file_info['category'], target_format)
+                
+                output_file.seek(0, io.SEEK_END)
+                output_size = output_file.tell()
+                if not success:
+                    await query.edit_message_text("❌ Conversion failed. Please try again.")
+                elif output_size > self.MAX_FILE_SIZE:
+                    await query.edit_message_text(
+                        "❌ Converted file is larger than 50MB and can't be sent."
+                    )
+                else:
+                    # The upload needs the whole file as bytes, so bound uploads separately
+                    async with self._upload_slots:
+                        # Read it off the event loop in case it spilled to disk
+                        output_file.seek(0)
+                        loop = asyncio.get_running_loop()
+                        converted_data = await loop.run_in_executor(self._pool, output_file.read)
+                        sent_message = await context.bot.send_document(
+                            chat_id=query.message.chat_id,
+                            document=converted_data,
+                            filename=output_filename,
+                            caption=f"✅ Converted to {target_format.upper()}"
+                        )
+                    await query.edit_message_text("✅ Conversion completed successfully!")
+                    
+                    # Remember the uploaded result, evicting the oldest entry when full.
+                    # Telegram may deliver it as something else (e.g. a .webp as a sticker).
+                    if sent_message.document:
+                        if len(conversion_cache) >= self.CONVERSION_CACHE_SIZE:
+                            conversion_cache.pop(next(iter(conversion_cache)))
+                        conversion_cache[cache_key] = sent_message.document.file_id
             
         except Exception as e:
             logger.error(f"Conversion error: {e}")
             await query.edit_message_text("❌ An error occurred during conversion.")
     
-    def convert_file(self, input_path: str, output_path: str, 
-                    category: str, target_format: str) -> bool:
-        """Convert file based on category"""
+    async def convert_file(self, source: Union[str, BinaryIO], output: Union[str, BinaryIO], 
+                           category: str, target_format: str) -> bool:
+        """Convert file based on category in the worker pool"""
+        loop = asyncio.get_running_loop()
         if category == 'image':
-            return self.converter.convert_image(input_path, output_path, target_format)
+            return await loop.run_in_executor(
+                self._pool, self.converter.convert_image, source, output, target_format
+            )
         return False
     
     def run(self):
         """Start the bot"""        
         logger.info("Starting File Converter Bot...")
-        self.application.run_polling()
+        try:
+            self.application.run_polling()
+        finally:
+            self._pool.shutdown()
 
 def main():
     # Get bot token from environment variable
@@ -255,6 +355,14 @@ def main():
         logger.error("Please set TELEGRAM_BOT_TOKEN environment variable")
         return
     
+    # libuv-based event loop for faster socket I/O (not available on Windows)
+    if sys.platform != 'win32':
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            logger.info("uvloop not installed, using the default asyncio event loop")
+    
     bot = TelegramBot(token)
     bot.run()
 